@@ -0,0 +1,47 @@
+import copy
+
+import diskcache
+import pytest
+
+from web.handlers import normalizer
+from web.utils import LRUCache
+
+
+class FakeBiothingsClient:
+    """stands in for a biothings client, answering querymany from a dict of documents by query id"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = []
+
+    def querymany(self, qterms, scopes=None, fields=None):
+        self.calls.append((list(qterms), fields))
+        res = []
+        for q in qterms:
+            if q in self.docs:
+                res.append({"query": q, "_id": q, "_score": 1.5, **copy.deepcopy(self.docs[q])})
+            else:
+                res.append({"query": q, "notfound": True})
+        return res
+
+
+@pytest.fixture
+def fake_client(monkeypatch, tmp_path):
+    """patch the normalizer to query a fake gene/chem/disease client and cache on disk under tmp_path"""
+    docs = {
+        "1017": {"name": "cyclin dependent kinase 2", "symbol": "CDK2", "summary": "..."},
+        "CHEBI:15365": {"chebi": {"id": "CHEBI:15365", "iupac": ["a", "b"]}, "drugbank": {"id": "DB00945"}},
+        "0005148": {"mondo": {"mondo": "MONDO:0005148", "label": "type 2 diabetes mellitus"}},
+    }
+    client = FakeBiothingsClient(docs)
+
+    def _get_client(node_type):
+        spec = normalizer.NORMALIZER_CLIENTS[node_type]
+        return client, spec["fields"], spec["scopes"]
+
+    cache = diskcache.Cache(str(tmp_path))
+    monkeypatch.setattr(normalizer, "_get_client", _get_client)
+    monkeypatch.setattr(normalizer, "_get_disk_cache", lambda: cache)
+    monkeypatch.setattr(normalizer, "_curie_cache", LRUCache(capacity=normalizer.CURIE_CACHE_SIZE))
+    yield client
+    cache.close()
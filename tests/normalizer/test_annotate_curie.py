@@ -0,0 +1,35 @@
+from web.handlers import normalizer
+from web.handlers.normalizer import Normalizer
+
+
+def test_01_annotate_curie(fake_client):
+    res = Normalizer().annotate_curie("NCBIGene:1017", fields="symbol")
+    assert res == {"NCBIGene:1017": [{"_id": "1017", "symbol": "CDK2"}]}
+
+
+def test_02_memory_cache_shared_by_field_order(fake_client):
+    annotator = Normalizer()
+    annotator.annotate_curie("NCBIGene:1017", fields="name,symbol")
+    # clearing the disk cache shows the second call is served from memory
+    normalizer._get_disk_cache().clear()
+    annotator.annotate_curie("NCBIGene:1017", fields=" symbol , name")
+    assert len(fake_client.calls) == 1
+
+
+def test_03_memory_cache_returns_copies(fake_client):
+    annotator = Normalizer()
+    res = annotator.annotate_curie("NCBIGene:1017")
+    res["NCBIGene:1017"][0]["symbol"] = "changed"
+    assert annotator.annotate_curie("NCBIGene:1017")["NCBIGene:1017"][0]["symbol"] == "CDK2"
+    again = annotator.annotate_curie("NCBIGene:1017")
+    again["NCBIGene:1017"].clear()
+    assert annotator.annotate_curie("NCBIGene:1017")["NCBIGene:1017"][0]["symbol"] == "CDK2"
+
+
+def test_04_memory_cache_expires(fake_client, monkeypatch):
+    monkeypatch.setattr(normalizer, "CURIE_CACHE_EXPIRE", 0)
+    annotator = Normalizer()
+    annotator.annotate_curie("NCBIGene:1017")
+    normalizer._get_disk_cache().clear()
+    annotator.annotate_curie("NCBIGene:1017")
+    assert len(fake_client.calls) == 2
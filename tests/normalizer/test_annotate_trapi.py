@@ -0,0 +1,76 @@
+import pytest
+
+from web.handlers.normalizer import Normalizer, TRAPIInputError
+
+EXISTING = {"attribute_type_id": "existing", "value": 1}
+
+
+def trapi(nodes):
+    return {"message": {"knowledge_graph": {"nodes": nodes, "edges": {}}}}
+
+
+def annotation(value):
+    return {"attribute_type_id": "biothings_annnotations", "value": value}
+
+
+def test_01_mixed_node_types(fake_client):
+    nodes = {"NCBIGene:1017": {}, "CHEBI:15365": {}, "MONDO:0005148": {}}
+    res = Normalizer().annotate_trapi(trapi(nodes))
+    assert res["NCBIGene:1017"]["attributes"][0]["value"][0]["symbol"] == "CDK2"
+    assert res["CHEBI:15365"]["attributes"][0]["value"][0]["drugbank"] == {"id": "DB00945"}
+    assert res["MONDO:0005148"]["attributes"][0]["value"][0]["mondo"]["label"] == "type 2 diabetes mellitus"
+    # one query per node type
+    assert sorted(ids for ids, _ in fake_client.calls) == [["0005148"], ["1017"], ["CHEBI:15365"]]
+
+
+def test_02_no_append_replaces_attributes(fake_client):
+    nodes = {"NCBIGene:1017": {"attributes": [EXISTING]}, "NCBIGene:0": {"attributes": [EXISTING]}}
+    res = Normalizer().annotate_trapi(trapi(nodes), append=False)
+    assert res["NCBIGene:1017"]["attributes"] == [
+        annotation([{"_id": "1017", "name": "cyclin dependent kinase 2", "symbol": "CDK2", "summary": "..."}])
+    ]
+    assert res["NCBIGene:0"]["attributes"] == [annotation([{"notfound": True}])]
+
+
+def test_03_append_keeps_attributes(fake_client):
+    nodes = {"NCBIGene:1017": {"attributes": [EXISTING]}}
+    res = Normalizer().annotate_trapi(trapi(nodes), append=True)
+    attributes = res["NCBIGene:1017"]["attributes"]
+    assert len(attributes) == 2
+    assert attributes[0] == EXISTING
+    assert attributes[1]["attribute_type_id"] == "biothings_annnotations"
+
+
+@pytest.mark.parametrize("append", [True, False])
+def test_04_missing_or_null_attributes(fake_client, append):
+    nodes = {"NCBIGene:1017": {}, "MONDO:0005148": {"attributes": None}}
+    res = Normalizer().annotate_trapi(trapi(nodes), append=append)
+    assert len(res["NCBIGene:1017"]["attributes"]) == 1
+    assert len(res["MONDO:0005148"]["attributes"]) == 1
+
+
+def test_05_unknown_and_malformed_ids(fake_client):
+    nodes = {"FOO:1": {"attributes": [EXISTING]}, "nocolon": {}, "NCBIGene:1017": {}}
+    res = Normalizer().annotate_trapi(trapi(nodes))
+    # unsupported ids are left untouched and never queried
+    assert res["FOO:1"] == {"attributes": [EXISTING]}
+    assert res["nocolon"] == {}
+    assert fake_client.calls == [(["1017"], ("name", "symbol", "summary", "type_of_gene", "MIM"))]
+
+
+def test_06_only_unsupported_ids(fake_client):
+    nodes = {"FOO:1": {}, "nocolon": {}}
+    assert Normalizer().annotate_trapi(trapi(nodes)) == nodes
+    assert fake_client.calls == []
+
+
+@pytest.mark.parametrize("trapi_input", [None, [], {}, {"message": None}, trapi([])])
+def test_07_invalid_input(fake_client, trapi_input):
+    with pytest.raises(TRAPIInputError):
+        Normalizer().annotate_trapi(trapi_input)
+
+
+def test_08_no_append_keeps_original_list(fake_client):
+    original = [EXISTING]
+    Normalizer().annotate_trapi(trapi({"NCBIGene:1017": {"attributes": original}}), append=False)
+    assert original == [EXISTING]
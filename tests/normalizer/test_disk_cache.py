@@ -0,0 +1,31 @@
+from web.handlers.normalizer import Normalizer
+
+
+def test_01_only_misses_are_queried(fake_client):
+    normalizer = Normalizer()
+    normalizer.query_biothings("gene", ["1017"])
+    normalizer.query_biothings("gene", ["1017", "missing"])
+    assert [ids for ids, _ in fake_client.calls] == [["1017"], ["missing"]]
+
+
+def test_02_hits_and_misses_merge_stripped(fake_client):
+    normalizer = Normalizer()
+    normalizer.query_biothings("gene", ["1017"], raw=False)
+    res = normalizer.query_biothings("gene", ["1017", "missing"], raw=False)
+    assert res == {
+        "1017": [{"_id": "1017", "name": "cyclin dependent kinase 2", "symbol": "CDK2", "summary": "..."}],
+        "missing": [{"notfound": True}],
+    }
+    # stripping the returned rows must not have touched the cached ones
+    res = normalizer.query_biothings("gene", ["1017", "missing"], raw=True)
+    assert res["1017"][0]["query"] == "1017"
+    assert res["1017"][0]["_score"] == 1.5
+    assert res["missing"] == [{"query": "missing", "notfound": True}]
+
+
+def test_03_repeat_call_uses_no_network(fake_client):
+    normalizer = Normalizer()
+    first = normalizer.query_biothings("disease", ["0005148"], raw=False)
+    second = normalizer.query_biothings("disease", ["0005148"], raw=False)
+    assert first == second
+    assert len(fake_client.calls) == 1
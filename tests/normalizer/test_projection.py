@@ -0,0 +1,95 @@
+from web.handlers.normalizer import Normalizer, _covered_by, _project_doc, _split_fields
+
+
+def test_01_split_fields():
+    assert _split_fields("name,symbol") == ["name", "symbol"]
+    assert _split_fields(" name , symbol ,, ") == ["name", "symbol"]
+    assert _split_fields("") == []
+    assert _split_fields(["name", " ", "symbol"]) == ["name", "symbol"]
+
+
+def test_02_covered_by():
+    defaults = ("mondo.mondo", "mondo.label", "chembl.drug_indications")
+    assert _covered_by("mondo.label", defaults)
+    assert _covered_by("chembl.drug_indications.efo_term", defaults)
+    # a parent field asks for more than the defaults return
+    assert not _covered_by("mondo", defaults)
+    assert not _covered_by("mondo.labels", defaults)
+    assert not _covered_by("all", defaults)
+
+
+def test_03_project_nested():
+    doc = {"query": "q", "_id": "1", "_score": 2.0, "mondo": {"mondo": "MONDO:1", "label": "x"}, "umls": {"umls": "C1"}}
+    assert _project_doc(doc, [["mondo", "label"]]) == {"query": "q", "_id": "1", "_score": 2.0, "mondo": {"label": "x"}}
+
+
+def test_04_project_lists():
+    doc = {
+        "_id": "1",
+        "chebi": {"id": "CHEBI:1", "iupac": ["a", "b"]},
+        "chembl": {"drug_indications": [{"efo_term": "x", "mesh_id": "D1"}, {"efo_term": "y"}, {"mesh_id": "D2"}]},
+    }
+    # a list value at the end of a path is kept whole
+    assert _project_doc(doc, [["chebi", "iupac"]]) == {"_id": "1", "chebi": {"iupac": ["a", "b"]}}
+    # a path continuing into a list is applied to each element, dropping the elements left empty
+    assert _project_doc(doc, [["chembl", "drug_indications", "efo_term"]]) == {
+        "_id": "1",
+        "chembl": {"drug_indications": [{"efo_term": "x"}, {"efo_term": "y"}]},
+    }
+    # a path continuing into a list of scalars matches nothing
+    assert _project_doc(doc, [["chebi", "iupac", "name"]]) == {"_id": "1"}
+
+
+def test_05_project_drops_empty_objects():
+    doc = {"_id": "1", "mondo": {"mondo": "MONDO:1"}, "umls": {"umls": "C1"}}
+    assert _project_doc(doc, [["mondo", "label"]]) == {"_id": "1"}
+    doc = {"_id": "1", "chembl": {"drug_indications": [{"mesh_id": "D1"}]}}
+    assert _project_doc(doc, [["chembl", "drug_indications", "efo_term"]]) == {"_id": "1"}
+
+
+def test_06_project_keeps_nested_metadata():
+    doc = {
+        "_id": "1",
+        "drugbank": {"_license": "http://example.org", "id": "DB1", "name": "x"},
+        "chebi": {"_license": "http://example.org", "id": "CHEBI:1"},
+    }
+    assert _project_doc(doc, [["drugbank", "id"]]) == {
+        "_id": "1",
+        "drugbank": {"_license": "http://example.org", "id": "DB1"},
+    }
+
+
+def test_07_project_whole_value():
+    doc = {"_id": "1", "chebi": {"id": "CHEBI:1", "iupac": ["a"]}}
+    # requesting both a field and its parent returns the whole parent
+    assert _project_doc(doc, [["chebi"], ["chebi", "id"]]) == doc
+
+
+def test_08_project_notfound():
+    doc = {"query": "q", "notfound": True}
+    assert _project_doc(doc, [["symbol"]]) == doc
+
+
+def test_09_query_projects_default_subset(fake_client):
+    res = Normalizer().query_biothings("gene", ["1017"], fields="symbol, name", raw=False)
+    assert res == {"1017": [{"_id": "1017", "name": "cyclin dependent kinase 2", "symbol": "CDK2"}]}
+    # the network query asks for the default fields, not the requested subset
+    assert fake_client.calls == [(["1017"], ("name", "symbol", "summary", "type_of_gene", "MIM"))]
+
+
+def test_10_query_passes_other_fields(fake_client):
+    Normalizer().query_biothings("disease", ["0005148"], fields="mondo", raw=False)
+    assert fake_client.calls == [(["0005148"], ["mondo"])]
+
+
+def test_11_query_raw(fake_client):
+    res = Normalizer().query_biothings("disease", ["0005148", "missing"], fields="mondo.label", raw=True)
+    assert res == {
+        "0005148": [{"query": "0005148", "_id": "0005148", "_score": 1.5, "mondo": {"label": "type 2 diabetes mellitus"}}],
+        "missing": [{"query": "missing", "notfound": True}],
+    }
+
+
+def test_12_query_chem_list_value(fake_client):
+    res = Normalizer().query_biothings("chem", ["CHEBI:15365"], fields="chebi.iupac", raw=False)
+    assert res == {"CHEBI:15365": [{"_id": "CHEBI:15365", "chebi": {"iupac": ["a", "b"]}}]}
@@ -1,15 +1,42 @@
 """
 Translator Node Normalizer Service Handler
 """
+import asyncio
+import copy
+import functools
 import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import biothings_client
-from biothings.utils.common import get_dotfield_value
+import diskcache
+import httpx
 from biothings.web.handlers import BaseAPIHandler
 from tornado.web import HTTPError
 
+from web.utils import LRUCache
+
 logger = logging.getLogger(__name__)
 
+# query lists longer than BATCH_SIZE are split and sent to biothings in parallel
+BATCH_SIZE = 1000
+MAX_CONCURRENCY = 4
+# size of the keep-alive connection pool shared by all queries of a biothings client
+HTTP_POOL_SIZE = 32
+HTTP_TIMEOUT = httpx.Timeout(60, connect=5)  # in seconds
+# querymany results are cached per query id on disk, shared across worker processes and restarts
+DISK_CACHE_DIR = os.environ.get("NORMALIZER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pending_api_normalizer"))
+DISK_CACHE_EXPIRE = 3600  # in seconds
+DISK_CACHE_SIZE_LIMIT = int(os.environ.get("NORMALIZER_CACHE_SIZE_LIMIT", 1024**3))  # in bytes, oldest entries are evicted first
+# annotate_curie results are also kept in memory. An entry may be built from a disk cache entry that is about to
+# expire, so results can be up to DISK_CACHE_EXPIRE + CURIE_CACHE_EXPIRE old
+CURIE_CACHE_SIZE = 8192
+CURIE_CACHE_EXPIRE = 300  # in seconds
+
 BIOLINK_PREFIX_to_BioThings = {
     "NCBIGene": {"type": "gene", "field": "entrezgene"},
     "ENSEMBL": {"type": "gene", "field": "ensembl.gene"},
@@ -34,144 +61,310 @@ class InvalidCurieError(ValueError):
     pass
 
 
-def list2dict(li, key):
-    out = {}
+def _group_and_transform(li, raw):
+    """group querymany results by their query id, stripping the biothings-added keys unless raw is set"""
+    out = defaultdict(list)
     for d in li:
-        k = d[key]
-        if k not in out:
-            out[k] = [d]
-        else:
-            out[k].append(d)
+        k = d["query"]
+        if not raw:
+            del d["query"]
+            if "_score" in d:
+                del d["_score"]
+        out[k].append(d)
+    return dict(out)
+
+
+def _split_fields(fields):
+    """return the requested fields as a list, fields can be a comma-separated string or a list"""
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    return [field.strip() for field in fields if field.strip()]
+
+
+def _covered_by(field, fields):
+    """check if a (dotted) field is included in the results of querying with fields"""
+    return any(field == f or field.startswith(f + ".") for f in fields)
+
+
+# returned by _project when nothing in a value matches the requested paths
+_NO_MATCH = object()
+
+
+def _project(value, paths):
+    """
+    keep only the given field paths (split on dots) of a biothings object, recursing into lists.
+    Like elasticsearch source filtering, objects and list items left empty are dropped (returning _NO_MATCH
+    if nothing matches), while metadata biothings adds inside a kept object, like _license, is preserved.
+    """
+    if any(not path for path in paths):
+        # the whole value is requested
+        return value
+    if isinstance(value, list):
+        items = [v for v in (_project(v, paths) for v in value) if v is not _NO_MATCH]
+        return items or _NO_MATCH
+    if not isinstance(value, dict):
+        # a scalar has no subfields to match
+        return _NO_MATCH
+    subpaths = defaultdict(list)
+    for path in paths:
+        subpaths[path[0]].append(path[1:])
+    out = {}
+    for k, sub in subpaths.items():
+        if k in value:
+            projected = _project(value[k], sub)
+            if projected is not _NO_MATCH:
+                out[k] = projected
+    if not out:
+        return _NO_MATCH
+    out.update((k, v) for k, v in value.items() if k.startswith("_") and k not in out)
     return out
 
 
-class Normalizer:
-    normalizer_clients = {
-        "gene": {
-            "client": biothings_client.get_client("gene"),
-            "fields": ["name", "symbol", "summary", "type_of_gene", "MIM"],
-            "scopes": ["entrezgene", "ensemblgene", "uniprot", "accession", "retired"],
-        },
-        "chem": {
-            "client": biothings_client.get_client("chem"),
-            "fields": [
-                "drugbank.id",
-                "chebi.id",
-                "chebi.iupac",
-                "chebi.relationship",
-                "chembl.smiles",
-                "chembl.first_approval",
-                "chembl.first_in_class",
-                "chembl.unii",
-                "chembl.drug_indications",
-                "chembl.drug_mechanisms",
-                "pubchem.molecular_weight",
-                "pubchem.molecular_formula",
-                "drugcentral.approval",
-            ],
-            "scopes": ["chebi.id", "chembl.molecule_chembl_id", "pubchem.cid", "drugbank.id", "unii.unii"],
-        },
-        "disease": {
-            "client": biothings_client.get_client("disease"),
-            "fields": ["mondo.mondo", "mondo.label", "mondo.definition", "umls.umls"],
-            "scopes": ["mondo.mondo", "doid.doid", "umls.umls"],
-        },
-    }
+def _project_doc(doc, paths):
+    """project a querymany result to the given field paths, keeping its metadata like _id, query and notfound"""
+    out = _project(doc, paths)
+    if out is _NO_MATCH:
+        out = {}
+    out.update((k, v) for k, v in doc.items() if k.startswith("_") or k in ("query", "notfound"))
+    return out
+
+
+# flattened view of BIOLINK_PREFIX_to_BioThings: prefix -> (type, keep_prefix, converter)
+_PREFIX_TABLE = {
+    prefix: (v.get("type"), v.get("keep_prefix", False), v.get("converter"))
+    for prefix, v in BIOLINK_PREFIX_to_BioThings.items()
+}
+_UNKNOWN_PREFIX = (None, False, None)
+_KNOWN_PREFIXES = frozenset(BIOLINK_PREFIX_to_BioThings)
+
+
+def _split_curie(curie):
+    if ":" not in curie:
+        raise InvalidCurieError(f"Invalid input curie id: {curie}")
+    return curie.split(":", 1)
+
+
+@functools.lru_cache(maxsize=65536)
+def _parse_curie_type(curie):
+    """return the node type of the input curie, or None if its prefix is not supported"""
+    _prefix, _ = _split_curie(curie)
+    return _PREFIX_TABLE.get(_prefix, _UNKNOWN_PREFIX)[0]
+
+
+@functools.lru_cache(maxsize=65536)
+def _parse_curie_id(curie):
+    """return the id of the input curie used to query biothings"""
+    _prefix, _id = _split_curie(curie)
+    _type, keep_prefix, cvtr = _PREFIX_TABLE.get(_prefix, _UNKNOWN_PREFIX)
+    if cvtr:
+        return cvtr(curie)
+    if not _type or keep_prefix:
+        return curie
+    return _id
+
 
+def parse_curie(curie):
+    """return both type and id (as a tuple) based on the input curie"""
+    return _parse_curie_type(curie), _parse_curie_id(curie)
+
+
+# default fields and query scopes of the biothings client used for each node type
+NORMALIZER_CLIENTS = {
+    "gene": {
+        "fields": ("name", "symbol", "summary", "type_of_gene", "MIM"),
+        "scopes": ("entrezgene", "ensemblgene", "uniprot", "accession", "retired"),
+    },
+    "chem": {
+        "fields": (
+            "drugbank.id",
+            "chebi.id",
+            "chebi.iupac",
+            "chebi.relationship",
+            "chembl.smiles",
+            "chembl.first_approval",
+            "chembl.first_in_class",
+            "chembl.unii",
+            "chembl.drug_indications",
+            "chembl.drug_mechanisms",
+            "pubchem.molecular_weight",
+            "pubchem.molecular_formula",
+            "drugcentral.approval",
+        ),
+        "scopes": ("chebi.id", "chembl.molecule_chembl_id", "pubchem.cid", "drugbank.id", "unii.unii"),
+    },
+    "disease": {
+        "fields": ("mondo.mondo", "mondo.label", "mondo.definition", "umls.umls"),
+        "scopes": ("mondo.mondo", "doid.doid", "umls.umls"),
+    },
+}
+
+
+def _build_client(biothing_type):
+    """return a biothings client whose connection pool fits our concurrent queries"""
+    client = biothings_client.get_client(biothing_type)
+    # biothings_client lazily builds an httpx.Client with the default pool limits on first query unless
+    # http_client_setup is set, so build it upfront with a larger keep-alive pool and connection retries instead.
+    # These attributes are shared by the 0.4 and 0.5 releases, which is the range pinned in requirements.txt
+    limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+    client.http_client = httpx.Client(transport=httpx.HTTPTransport(limits=limits, retries=3), timeout=HTTP_TIMEOUT)
+    client.http_client_setup = True
+    return client
+
+
+@functools.cache
+def _get_client(node_type):
+    """return (client, default fields, scopes) for node_type, the client is created on first use"""
+    spec = NORMALIZER_CLIENTS[node_type]
+    return _build_client(node_type), spec["fields"], spec["scopes"]
+
+
+@functools.cache
+def _get_disk_cache():
+    """return the disk cache of querymany results, created on first use"""
+    return diskcache.Cache(DISK_CACHE_DIR, size_limit=DISK_CACHE_SIZE_LIMIT)
+
+
+# (curie, raw, fields) -> (expiry time, annotate_curie result), guarded by a lock since handlers call it from threads
+_curie_cache = LRUCache(capacity=CURIE_CACHE_SIZE)
+_curie_cache_lock = threading.Lock()
+
+
+class Normalizer:
     def parse_curie(self, curie, return_type=True, return_id=True):
         """return a both type and if (as a tuple) or either based on the input curie"""
-        if ":" not in curie:
-            raise InvalidCurieError(f"Invalid input curie id: {curie}")
-        _prefix, _id = curie.split(":", 1)
-        _type = BIOLINK_PREFIX_to_BioThings.get(_prefix, {}).get("type", None)
-        if return_id:
-            if not _type or BIOLINK_PREFIX_to_BioThings[_prefix].get("keep_prefix", False):
-                _id = curie
-            cvtr = BIOLINK_PREFIX_to_BioThings.get(_prefix, {}).get("converter", None)
-            if cvtr:
-                _id = cvtr(curie)
         if return_type and return_id:
-            return _type, _id
+            return parse_curie(curie)
         elif return_type:
-            return _type
+            return _parse_curie_type(curie)
         elif return_id:
-            return _id
+            return _parse_curie_id(curie)
 
-    def query_biothings(self, node_type, query_list, fields=None):
+    def query_biothings(self, node_type, query_list, fields=None, raw=True):
         """Query biothings client based on node_type for a list of ids"""
-        client = self.normalizer_clients[node_type]["client"]
-        fields = fields or self.normalizer_clients[node_type]["fields"]
-        scopes = self.normalizer_clients[node_type]["scopes"]
-        logger.info("Querying annotations for %s %ss...", len(query_list), node_type)
-        res = client.querymany(query_list, scopes=scopes, fields=fields)
-        logger.info("Done. %s annotation objects returned.", len(res))
-        res = list2dict(res, "query")
+        client, default_fields, scopes = _get_client(node_type)
+        paths = None
+        if fields:
+            fields = _split_fields(fields)
+            if all(_covered_by(field, default_fields) for field in fields):
+                # always fetch the default fields so that results can be shared by any subset of them,
+                # then project the results down to the requested fields
+                paths = [field.split(".") for field in fields]
+                fields = None
+        fields = fields or default_fields
+        fields_key = fields if isinstance(fields, str) else tuple(fields)
+
+        # only send the ids not found in the disk cache to biothings
+        cache = _get_disk_cache()
+        res = []
+        missed_list = []
+        # one transaction for all lookups instead of one per query id
+        with cache.transact():
+            for query_id in query_list:
+                cached = cache.get((node_type, query_id, fields_key))
+                if cached is None:
+                    missed_list.append(query_id)
+                else:
+                    res.extend(cached)
+        logger.info(
+            "Querying annotations for %s %ss (%s cached)...",
+            len(missed_list),
+            node_type,
+            len(query_list) - len(missed_list),
+        )
+        if missed_list:
+            if len(missed_list) > BATCH_SIZE:
+                batches = [missed_list[i : i + BATCH_SIZE] for i in range(0, len(missed_list), BATCH_SIZE)]
+                with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+                    batch_results = executor.map(
+                        lambda batch: client.querymany(batch, scopes=scopes, fields=fields), batches
+                    )
+                    new_res = [r for batch_res in batch_results for r in batch_res]
+            else:
+                new_res = client.querymany(missed_list, scopes=scopes, fields=fields)
+            logger.info("Done. %s annotation objects returned.", len(new_res))
+            # cache.set pickles the rows right away, which must happen before they are stripped in place below
+            with cache.transact():
+                for query_id, rows in _group_and_transform(new_res, raw=True).items():
+                    cache.set((node_type, query_id, fields_key), rows, expire=DISK_CACHE_EXPIRE)
+            res.extend(new_res)
+        if paths:
+            res = [_project_doc(d, paths) for d in res]
+        res = _group_and_transform(res, raw)
         return res
 
     def annotate_curie(self, curie, raw=False, fields=None):
-        """Annotate a single curie id"""
+        """Annotate a single curie id, results are cached in memory for CURIE_CACHE_EXPIRE seconds"""
+        if fields:
+            # make fields hashable and order-insensitive for the cache key
+            fields = tuple(sorted(_split_fields(fields))) or None
+        key = (curie, raw, fields)
+        with _curie_cache_lock:
+            cached = _curie_cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            # callers own the returned object, so never hand out the cached one
+            return copy.deepcopy(cached[1])
+
         node_type, _id = self.parse_curie(curie)
-        res = self.query_biothings(node_type, [_id], fields=fields)
+        res = self.query_biothings(node_type, [_id], fields=fields, raw=raw)
         if not raw:
-            res = [self.transform(r) for r in res[_id]]
-        return {curie: res}
-
-    def transform(self, res):
-        """perform any transformation on the annotation object, but in-place also returned object"""
-        res.pop("query", None)
-        res.pop("_score", None)
+            res = res[_id]
+        res = {curie: res}
+        with _curie_cache_lock:
+            _curie_cache.put(key, (time.monotonic() + CURIE_CACHE_EXPIRE, copy.deepcopy(res)))
         return res
 
     def annotate_trapi(self, trapi_input, append=False, raw=False, fields=None):
         """Annotate a TRAPI input message with node normalizer annotations"""
         try:
-            node_d = get_dotfield_value("message.knowledge_graph.nodes", trapi_input)
-            assert isinstance(node_d, dict)
-        except (KeyError, ValueError, AssertionError):
+            node_d = trapi_input["message"]["knowledge_graph"]["nodes"]
+        except (KeyError, TypeError):
+            raise TRAPIInputError("Invalid input format")
+        if not isinstance(node_d, dict):
             raise TRAPIInputError("Invalid input format")
 
-        node_list_by_type = {}
+        # node_type -> (original node ids like NCBIGene:1017, query ids like 1017), built in a single pass
+        by_type = {}
         for node_id in node_d:
-            node_type = self.parse_curie(node_id, return_type=True, return_id=False)
-            if not node_type:
-                logger.info("%s - %s", node_type, node_id)
-            if node_type:
-                if node_type not in node_list_by_type:
-                    node_list_by_type[node_type] = [node_id]
-                else:
-                    node_list_by_type[node_type].append(node_id)
-        for node_type in node_list_by_type:
-            if node_type not in self.normalizer_clients or not node_list_by_type[node_type]:
+            # skip malformed or unsupported curies before doing the full parse
+            _prefix, sep, _ = node_id.partition(":")
+            if not sep or _prefix not in _KNOWN_PREFIXES:
+                logger.debug("Skipping unsupported node id: %s", node_id)
+                continue
+            node_type, query_id = self.parse_curie(node_id)
+            if node_type not in NORMALIZER_CLIENTS:
                 # skip for now
                 continue
-            # this is the list of original node ids like NCBIGene:1017, should be a unique list
-            node_list = node_list_by_type[node_type]
-            # this is the list of query ids like 1017
-            query_list = [
-                self.parse_curie(_id, return_type=False, return_id=True) for _id in node_list_by_type[node_type]
-            ]
-            # query_id to original id mapping
-            node_id_d = dict(zip(query_list, node_list))
-            res_by_id = self.query_biothings(node_type, query_list, fields=fields)
-            for node_id in res_by_id:
-                orig_node_id = node_id_d[node_id]
-                res = res_by_id[node_id]
-                if not raw:
-                    if isinstance(res, list):
-                        # TODO: handle multiple results here
-                        res = [self.transform(r) for r in res]
+            node_ids, query_ids = by_type.setdefault(node_type, ([], []))
+            node_ids.append(node_id)
+            query_ids.append(query_id)
+
+        if not by_type:
+            return node_d
+
+        # send all biothings queries out concurrently, one per node type
+        with ThreadPoolExecutor(max_workers=len(by_type)) as executor:
+            futures = {
+                executor.submit(self.query_biothings, node_type, query_ids, fields=fields, raw=raw): node_type
+                for node_type, (_, query_ids) in by_type.items()
+            }
+            # merge results into node_d serially as each query completes
+            for future in as_completed(futures):
+                node_ids, query_ids = by_type[futures[future]]
+                # query_id to original id mapping
+                node_id_d = dict(zip(query_ids, node_ids))
+                for node_id, res in future.result().items():
+                    node = node_d[node_id_d[node_id]]
+                    # TODO: handle multiple results here
+                    res = {
+                        "attribute_type_id": "biothings_annnotations",
+                        "value": res,
+                    }
+                    if append and node.get("attributes") is not None:
+                        # append annotations to existing "attributes" field
+                        node["attributes"].append(res)
                     else:
-                        res = self.transform(res)
-                res = {
-                    "attribute_type_id": "biothings_annnotations",
-                    "value": res,
-                }
-                if append:
-                    # append annotations to existing "attributes" field
-                    node_d[orig_node_id]["attributes"].append(res)
-                else:
-                    # return annotations only
-                    node_d[orig_node_id]["attributes"] = [res]
+                        # return annotations only, without modifying the caller's original list
+                        node["attributes"] = [res]
 
         return node_d
 
@@ -188,19 +381,25 @@ class NormalizerHandler(BaseAPIHandler):
         },
     }
 
+    # Normalizer holds no per-request state and its biothings clients are thread-safe, so share one instance
+    normalizer = Normalizer()
+
     async def get(self, *args, **kwargs):
-        normalizer = Normalizer()
         curie = args[0] if args else None
         if curie:
-            annotated_node = normalizer.annotate_curie(curie, raw=self.args.raw, fields=self.args.fields)
+            # run in a worker thread so that the blocking biothings query does not block the event loop
+            annotated_node = await asyncio.to_thread(
+                self.normalizer.annotate_curie, curie, raw=self.args.raw, fields=self.args.fields
+            )
             self.finish(annotated_node)
         else:
             raise HTTPError(404, reason="missing required input curie id")
 
     async def post(self, *args, **kwargs):
-        normalizer = Normalizer()
         try:
-            annotated_node_d = normalizer.annotate_trapi(
+            # run in a worker thread so that the blocking biothings queries do not block the event loop
+            annotated_node_d = await asyncio.to_thread(
+                self.normalizer.annotate_trapi,
                 self.args_json,
                 append=self.args.append,
                 raw=self.args.raw,